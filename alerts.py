@@ -0,0 +1,164 @@
+"""Low-stock alerts for purchasing.
+
+    python alerts.py [--every SECONDS] [--batch 100]
+
+Stock changes add up their net change per model on the session, and
+changing a reorder level notes the old one. Just before the transaction
+commits, only the touched models are checked, all in one query, and a
+model gets a row in the alert outbox, in the same transaction, when
+this transaction took it from above its reorder level to at or below
+it. Whether that happened follows from the database alone. The touched
+models' rows are locked before their stock is summed, so transactions
+changing the same model's stock, in any worker and at any location, are
+checked one after another, each seeing the ones committed before it;
+that makes one alert per drop.
+
+Run this module to send the outbox in batches. It posts JSON to
+ALERT_WEBHOOK_URL when that is set, and otherwise prints the alerts.
+"""
+
+import argparse
+import json
+import os
+import time
+import urllib2
+from datetime import datetime
+
+from sqlalchemy import event
+
+from model import Alert, Model, Stock, db
+
+
+def init_app(app):
+    """Evaluate touched models whenever the session commits."""
+
+    if not event.contains(db.session, "before_commit", _before_commit):
+        event.listen(db.session, "before_commit", _before_commit)
+        event.listen(db.session, "after_rollback", _after_rollback)
+
+
+def touch(model_code, change=0):
+    """Add `change` to a model's stock change in the current transaction."""
+
+    touched = db.session.info.setdefault("touched_models", {})
+    touched[model_code] = touched.get(model_code, 0) + change
+
+
+def level_changed(model_code, old_level):
+    """Note that a model's reorder level was `old_level` before this."""
+
+    db.session.info.setdefault("old_levels", {}).setdefault(model_code,
+                                                            old_level)
+    touch(model_code)
+
+
+def _before_commit(session):
+    touched = session.info.pop("touched_models", None)
+    old_levels = session.info.pop("old_levels", {})
+    if not touched:
+        return
+
+    # Wait for any other transaction checking these models to commit, so
+    # the sum below includes its stock changes. Under READ COMMITTED each
+    # statement sees what was committed before it started. Locking in
+    # order keeps two transactions from waiting on each other.
+    (session.query(Model.model_code)
+     .filter(Model.model_code.in_(touched))
+     .order_by(Model.model_code)
+     .with_for_update()
+     .all())
+
+    rows = (session.query(Model.model_code, Model.reorder_level,
+                          db.func.coalesce(db.func.sum(Stock.quantity), 0))
+            .outerjoin(Stock, Stock.model_code == Model.model_code)
+            .filter(Model.model_code.in_(touched),
+                    Model.reorder_level != None)
+            .group_by(Model.model_code, Model.reorder_level)
+            .all())
+
+    now = datetime.utcnow()
+    alerts = []
+
+    for model_code, reorder_level, on_hand in rows:
+        if on_hand > reorder_level:
+            continue
+
+        level_before = old_levels.get(model_code, reorder_level)
+        on_hand_before = on_hand - touched[model_code]
+        was_low = (level_before is not None and
+                   on_hand_before <= level_before)
+
+        if not was_low:
+            alerts.append({"model_code": model_code,
+                           "on_hand": on_hand,
+                           "reorder_level": reorder_level,
+                           "created_at": now})
+
+    if alerts:
+        session.execute(Alert.__table__.insert(), alerts)
+
+
+def _after_rollback(session):
+    session.info.pop("touched_models", None)
+    session.info.pop("old_levels", None)
+
+
+def send_pending(webhook_url=None, batch_size=100):
+    """Send unsent alerts a batch at a time; return how many were sent."""
+
+    sent = 0
+
+    while True:
+        batch = (Alert.query.filter(Alert.sent_at == None)
+                 .order_by(Alert.alert_id)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            break
+
+        payload = [{"alert_id": alert.alert_id,
+                    "model_code": alert.model_code,
+                    "on_hand": alert.on_hand,
+                    "reorder_level": alert.reorder_level,
+                    "created_at": alert.created_at.isoformat()}
+                   for alert in batch]
+
+        if webhook_url:
+            request = urllib2.Request(webhook_url, json.dumps(payload),
+                                      {"Content-Type": "application/json"})
+            urllib2.urlopen(request, timeout=10).close()
+        else:
+            for alert in payload:
+                print "Low stock: %(model_code)s has %(on_hand)s on hand " \
+                      "(reorder at %(reorder_level)s)" % alert
+
+        now = datetime.utcnow()
+        Alert.query.filter(
+            Alert.alert_id.in_([alert.alert_id for alert in batch])).update(
+            {Alert.sent_at: now}, synchronize_session=False)
+        db.session.commit()
+
+        sent += len(batch)
+
+    return sent
+
+
+if __name__ == "__main__":
+    from server import app
+    from model import connect_to_db
+
+    parser = argparse.ArgumentParser(description="Send low-stock alerts.")
+    parser.add_argument("--every", type=float,
+                        help="keep running, sending every this many seconds")
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    with app.app_context():
+        while True:
+            send_pending(os.environ.get('ALERT_WEBHOOK_URL'), args.batch)
+            if not args.every:
+                break
+            time.sleep(args.every)
@@ -0,0 +1,124 @@
+"""Archive items that were shipped out long ago.
+
+    python archive.py [--days 365] [--batch 10000]
+
+Moves every item shipped out more than --days ago from items into
+items_archive, a batch per transaction, so the tables the scanners and
+recent reports hit stay the size of the working set. Run it nightly,
+e.g. from cron:
+
+    15 3 * * * cd /home/ubuntu/Avue_Project && python archive.py
+
+Reports read the archive only when their date range reaches back to
+what has been archived; see items_between().
+"""
+
+import argparse
+import datetime
+
+from model import ArchivedItem, Item, db
+
+COLUMNS = ("item_id", "model_code", "shipped_in", "shipped_out",
+           "serial_number", "description", "manufacturer", "customer",
+           "img_url", "location_id")
+
+REPORT_COLUMNS = ("shipped_in", "shipped_out", "serial_number",
+                  "manufacturer", "customer")
+
+
+def archive_shipped(cutoff, batch_size=10000):
+    """Move items shipped out before `cutoff` to the archive.
+
+    Returns how many items were moved.
+    """
+
+    items = Item.__table__
+    archive = ArchivedItem.__table__
+    moved = 0
+
+    # Ordered on a unique key, so the insert and the delete pick out the
+    # same rows.
+    batch = (db.select([items.c.item_id])
+             .where(items.c.shipped_out < cutoff)
+             .order_by(items.c.shipped_out, items.c.item_id)
+             .limit(batch_size))
+
+    while True:
+        inserted = db.session.execute(archive.insert().from_select(
+            COLUMNS,
+            db.select([items.c[column] for column in COLUMNS])
+            .where(items.c.item_id.in_(batch))))
+        if not inserted.rowcount:
+            break
+
+        db.session.execute(items.delete().where(items.c.item_id.in_(batch)))
+        db.session.commit()
+
+        moved += inserted.rowcount
+
+    db.session.commit()
+
+    return moved
+
+
+def archived_through():
+    """The latest ship-out date in the archive, or None if it's empty.
+
+    Every archived item was shipped in and out on or before this date.
+    """
+
+    return db.session.query(db.func.max(ArchivedItem.shipped_out)).scalar()
+
+
+def items_between(model_code, date_column, starting_date, ending_date):
+    """Items of a model whose `date_column` falls within the range.
+
+    Rows come back ordered by that date, then serial number. The archive
+    is only searched when the range starts on or before the last date
+    it holds; recent reports never touch it.
+    """
+
+    tables = [Item.__table__]
+
+    boundary = archived_through()
+    if boundary is not None and starting_date <= boundary:
+        tables.append(ArchivedItem.__table__)
+
+    selects = [db.select([table.c[column] for column in REPORT_COLUMNS])
+               .where(db.and_(table.c.model_code == model_code,
+                              table.c[date_column].between(starting_date,
+                                                           ending_date)))
+               for table in tables]
+
+    order_by = (db.literal_column(date_column),
+                db.literal_column("serial_number"))
+    if len(selects) == 1:
+        query = selects[0].order_by(*order_by)
+    else:
+        query = db.union_all(*selects).order_by(*order_by)
+
+    return db.session.execute(query).fetchall()
+
+
+def find_item(serial_number):
+    """The item with this serial number, archived or not."""
+
+    return (Item.query.filter_by(serial_number=serial_number).first() or
+            ArchivedItem.query.filter_by(serial_number=serial_number).first())
+
+
+if __name__ == "__main__":
+    from server import app
+    from model import connect_to_db
+
+    parser = argparse.ArgumentParser(description="Archive shipped items.")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--batch", type=int, default=10000)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    db.create_all()
+
+    cutoff = datetime.date.today() - datetime.timedelta(days=args.days)
+    print "Archived %d items shipped out before %s." % (
+        archive_shipped(cutoff, args.batch), cutoff)
@@ -0,0 +1,467 @@
+"""Benchmarks for the warehouse app.
+
+    python bench.py buttons [--requests N]
+    python bench.py metrics [--requests N]
+    python bench.py workflows [--scale 10k|100k|1m] [--db-uri URI]
+                              [--requests N] [--output results.json]
+    python bench.py compare old.json new.json [--threshold PERCENT]
+    python bench.py startup [--runs N] [--db-uri URI]
+
+`buttons` renders /buttons with templates in development mode (reloading,
+no page cache) and then in production mode, and prints requests/sec for
+each. `metrics` measures what request and SQL instrumentation costs, on
+/buttons and on a serial number lookup against a scratch SQLite db: end
+to end with it switched on and off, and the hooks' own time per request
+on their own, which stays readable when the machine is too noisy to
+resolve a percent or two end to end.
+
+`workflows` fills a database with a catalog and item history from
+generate.py at the given scale, then times the scanner and report workflows one
+request at a time and writes throughput and p50/p99 latency per route as
+JSON. Without --db-uri it uses a throwaway SQLite file; point it at a
+scratch Postgres database to measure the real thing. Everything in that
+database is dropped first.
+
+`compare` diffs two workflow results and exits non-zero when any route's
+p50 or p99 got slower by more than the threshold (default 10%).
+
+`startup` starts the app in a fresh interpreter --runs times, the way
+wsgi.py does and the way the development server does, and prints the
+median time spent importing, configuring, and serving the first and
+second page and serial number lookup. Under gunicorn with preload_app,
+only the requests happen in each worker.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from flask import _request_ctx_stack
+
+from server import app
+from model import Item, connect_to_db, db
+import generate
+import metrics
+import templating
+
+SCALES = {
+    "10k": 10000,
+    "100k": 100000,
+    "1m": 1000000,
+}
+
+BENCH_USER = "user1"
+BENCH_PASSWORD = "bench-password"
+
+# Run in a new interpreter so nothing is imported or compiled yet.
+STARTUP_RUN = """
+import json, os, sys, time
+timings = []
+def phase(name, started):
+    timings.append((name, round((time.time() - started) * 1000, 1)))
+started = time.time()
+import server
+phase("import", started)
+started = time.time()
+if sys.argv[1] == "production":
+    import wsgi
+else:
+    from model import connect_to_db
+    connect_to_db(server.app, os.environ["DATABASE_URL"])
+    server.app.config["SQLALCHEMY_ECHO"] = False
+    server.templating.init_app(server.app)
+phase("create app", started)
+client = server.app.test_client()
+with client.session_transaction() as session:
+    session["user_id"] = 1
+for attempt in ("first", "second"):
+    started = time.time()
+    client.get("/buttons")
+    phase("%s /buttons" % attempt, started)
+for attempt in ("first", "second"):
+    started = time.time()
+    client.post("/info_for_serial_number", data={"serial_number": 1})
+    phase("%s lookup" % attempt, started)
+print json.dumps(timings)
+"""
+
+
+def requests_per_second(client, path, requests):
+    """Time `requests` GETs of `path` and return the rate."""
+
+    start = time.time()
+    for _ in xrange(requests):
+        client.get(path)
+    elapsed = time.time() - start
+
+    return requests / elapsed
+
+
+def connect_scratch_db(db_uri=None):
+    """Connect the app to `db_uri`, or to a new SQLite file.
+
+    Returns the SQLite file's path so the caller can remove it, or None.
+    """
+
+    path = None
+    if not db_uri:
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        db_uri = "sqlite:///%s" % path
+
+    connect_to_db(app, db_uri=db_uri)
+    app.config['SQLALCHEMY_ECHO'] = False
+    templating.init_app(app, production=True)
+
+    return path
+
+
+def bench_buttons(requests=2000):
+    """Compare /buttons before and after production template mode."""
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+
+    templating.init_app(app, production=False)
+    client.get("/buttons")
+    before = requests_per_second(client, "/buttons", requests)
+
+    templating.init_app(app, production=True)
+    client.get("/buttons")
+    after = requests_per_second(client, "/buttons", requests)
+    templating.clear()
+
+    print "/buttons development: %.0f req/s" % before
+    print "/buttons production:  %.0f req/s" % after
+
+
+def bench_metrics(requests=2000):
+    """Compare requests/sec with instrumentation switched on and off."""
+
+    path = connect_scratch_db()
+
+    db.create_all()
+    generate.generate(1, users=1, locations=1)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+
+    def lookup():
+        client.post("/info_for_serial_number", data={"serial_number": 1})
+
+    # Short alternating rounds so drift in machine load hits both sides
+    # equally. Each round pairs an off run with the on run next to it,
+    # and the median of those paired differences is the overhead, which
+    # a noisy round or two can't move.
+    rounds = 100
+    per_round = max(requests // rounds, 1)
+
+    for name, request in [("/buttons", lambda: client.get("/buttons")),
+                          ("/info_for_serial_number", lookup)]:
+        timings = {False: [], True: []}
+        for round_number in xrange(rounds):
+            # Take turns going first, so neither side always runs warm.
+            order = (False, True) if round_number % 2 else (True, False)
+            for enabled in order:
+                app.config['METRICS_ENABLED'] = enabled
+                start = time.time()
+                for _ in xrange(per_round):
+                    request()
+                timings[enabled].append((time.time() - start) / per_round)
+
+        overheads = sorted((on - off) / off for off, on
+                           in zip(timings[False], timings[True]))
+        off = sorted(timings[False])[rounds // 2]
+        on = sorted(timings[True])[rounds // 2]
+        print "%s off: %.0f req/s  on: %.0f req/s  overhead: %.1f%%" % (
+            name, 1 / off, 1 / on, 100 * overheads[rounds // 2])
+
+        queries = metrics._queries[name]
+        statements = int(round(queries.sum / queries.count))
+        hooks = instrumentation_seconds(name, statements)
+        print "%s hooks: %.1f us with %d statements, %.1f%% of %.0f us" % (
+            name, hooks * 1e6, statements, 100 * hooks / on, on * 1e6)
+
+    app.config['METRICS_ENABLED'] = True
+    os.remove(path)
+
+
+def instrumentation_seconds(path, statements, loops=20000):
+    """Time the request and SQL hooks alone for one request to `path`."""
+
+    class Connection(object):
+        info = {}
+
+    connection = Connection()
+    ignore = lambda environ, start_response: None
+    timed = metrics._timed(app, ignore)
+
+    with app.test_request_context(path):
+        _request_ctx_stack.top.match_request()
+        environ = _request_ctx_stack.top.request.environ
+        response = app.response_class()
+
+        def run(wsgi_app, hooks):
+            start = time.time()
+            for _ in xrange(loops):
+                wsgi_app(environ, None)
+                if hooks:
+                    for _ in xrange(statements):
+                        metrics._before_cursor(connection, None, "SELECT 1",
+                                               (), None, False)
+                        metrics._after_cursor(connection, None, "SELECT 1",
+                                              (), None, False)
+                    metrics._finish_request(response)
+                    metrics._finish_failed_request(None)
+            return time.time() - start
+
+        elapsed = run(timed, True) - run(ignore, False)
+
+    return elapsed / loops
+
+
+def load_synthetic(item_count, seed, years=2):
+    """Fill the database with a generated history of `item_count` items.
+
+    Returns the serial numbers still in stock, the model codes, the
+    location ids and the date range the history covers.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    model_codes, location_ids = generate.generate(
+        item_count, users=1, years=years, seed=seed,
+        user_password=BENCH_PASSWORD)
+    in_stock = [serial_number for (serial_number,) in db.session.query(
+        Item.serial_number).filter(Item.shipped_out == None)]
+
+    today = datetime.date.today()
+    first_day = today - datetime.timedelta(days=int(365 * years))
+
+    return in_stock, model_codes, location_ids, (first_day, today)
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def time_requests(make_request, requests):
+    """Run `make_request` `requests` times; return its timing summary."""
+
+    make_request()
+
+    latencies = []
+    start = time.time()
+    for _ in xrange(requests):
+        began = time.time()
+        make_request()
+        latencies.append(time.time() - began)
+    elapsed = time.time() - start
+
+    latencies.sort()
+
+    return {"requests": requests,
+            "throughput": round(requests / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_workflows(scale="10k", db_uri=None, requests=200, output=None,
+                    seed=0):
+    """Time each warehouse workflow against a synthetic history."""
+
+    item_count = SCALES[scale]
+    rng = random.Random(seed)
+    path = connect_scratch_db(db_uri)
+
+    started = time.time()
+    in_stock, model_codes, location_ids, (first_day, last_day) = \
+        load_synthetic(item_count, seed)
+    load_seconds = time.time() - started
+
+    client = app.test_client()
+    next_serial = [item_count + 1]
+
+    def check(response):
+        if response.status_code >= 500:
+            raise RuntimeError("%s from %s" % (response.status, response))
+
+    def login():
+        check(client.post("/login", data={"user_name": BENCH_USER,
+                                          "password": BENCH_PASSWORD}))
+
+    def ship_in():
+        check(client.post("/ship_in", data={
+            "serial_number": next_serial[0],
+            "description": "Benchmark item",
+            "model_code": rng.choice(model_codes),
+            "manufacturer": "Benchmark",
+            "location_id": rng.choice(location_ids)}))
+        next_serial[0] += 1
+
+    def ship_out():
+        serial_number = in_stock.pop(rng.randrange(len(in_stock)))
+        check(client.post("/ship_out", data={"serial_number": serial_number,
+                                             "customer": "Benchmark"}))
+
+    def info_for_serial_number():
+        check(client.post("/info_for_serial_number", data={
+            "serial_number": rng.randint(1, item_count)}))
+
+    def info_for_model_number():
+        start_date = first_day + datetime.timedelta(
+            days=rng.randint(0, (last_day - first_day).days - 30))
+        end_date = start_date + datetime.timedelta(days=30)
+        check(client.post("/info_for_model_number", data={
+            "model_code": rng.choice(model_codes),
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()}))
+
+    results = {}
+    for route, make_request in [("/login", login),
+                                ("/ship_in", ship_in),
+                                ("/ship_out", ship_out),
+                                ("/info_for_serial_number",
+                                 info_for_serial_number),
+                                ("/info_for_model_number",
+                                 info_for_model_number)]:
+        results[route] = time_requests(make_request, requests)
+        print "%-24s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms" % (
+            route, results[route]["throughput"], results[route]["p50_ms"],
+            results[route]["p99_ms"])
+
+    report = {"meta": {"scale": scale,
+                       "items": item_count,
+                       "database": db.engine.dialect.name,
+                       "load_seconds": round(load_seconds, 1),
+                       "requests": requests,
+                       "seed": seed,
+                       "revision": git_revision()},
+              "results": results}
+
+    if output:
+        with open(output, "w") as results_file:
+            json.dump(report, results_file, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            results_file.write("\n")
+
+    if path:
+        os.remove(path)
+
+    return report
+
+
+def bench_startup(runs=5, db_uri=None):
+    """Time cold starts in production and development configuration."""
+
+    path = connect_scratch_db(db_uri)
+
+    db.drop_all()
+    db.create_all()
+    generate.generate(100, users=1, years=0.5)
+    db.session.remove()
+
+    env = dict(os.environ, DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'])
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    medians = {}
+    for mode in ("production", "development"):
+        samples = []
+        for _ in xrange(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", STARTUP_RUN, mode], env=env, cwd=cwd)
+            samples.append(json.loads(output.splitlines()[-1]))
+
+        medians[mode] = [(name, sorted(run[i][1] for run in samples)[runs // 2])
+                         for i, (name, _) in enumerate(samples[0])]
+
+    print "%-16s %12s %12s" % ("", "production", "development")
+    for (name, production), (_, development) in zip(medians["production"],
+                                                    medians["development"]):
+        print "%-16s %9.1f ms %9.1f ms" % (name, production, development)
+
+    if path:
+        os.remove(path)
+
+
+def compare(old_path, new_path, threshold=10.0):
+    """Print how each route moved; return True if none regressed."""
+
+    with open(old_path) as old_file:
+        old = json.load(old_file)["results"]
+    with open(new_path) as new_file:
+        new = json.load(new_file)["results"]
+
+    ok = True
+    for route in sorted(set(old) & set(new)):
+        for stat in ("p50_ms", "p99_ms"):
+            before = old[route][stat]
+            after = new[route][stat]
+            change = 100.0 * (after - before) / before if before else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                ok = False
+            print "%-24s %s %8.2f -> %8.2f ms (%+.1f%%)%s" % (
+                route, stat, before, after, change, flag)
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warehouse benchmarks.")
+    commands = parser.add_subparsers(dest="command")
+
+    for name in ("buttons", "metrics"):
+        command = commands.add_parser(name)
+        command.add_argument("--requests", type=int, default=2000)
+
+    command = commands.add_parser("workflows")
+    command.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    command.add_argument("--db-uri")
+    command.add_argument("--requests", type=int, default=200)
+    command.add_argument("--output")
+    command.add_argument("--seed", type=int, default=0)
+
+    command = commands.add_parser("compare")
+    command.add_argument("old")
+    command.add_argument("new")
+    command.add_argument("--threshold", type=float, default=10.0)
+
+    command = commands.add_parser("startup")
+    command.add_argument("--runs", type=int, default=5)
+    command.add_argument("--db-uri")
+
+    args = parser.parse_args()
+
+    if args.command == "buttons":
+        bench_buttons(args.requests)
+    elif args.command == "metrics":
+        bench_metrics(args.requests)
+    elif args.command == "workflows":
+        bench_workflows(args.scale, args.db_uri, args.requests, args.output,
+                        args.seed)
+    elif args.command == "compare":
+        sys.exit(0 if compare(args.old, args.new, args.threshold) else 1)
+    elif args.command == "startup":
+        bench_startup(args.runs, args.db_uri)
@@ -0,0 +1,276 @@
+"""Generate a production-sized avuewarehouse database.
+
+    python generate.py --items 10000000 [--models 5000] [--users 100]
+                       [--customers 20000] [--locations 3] [--years 5]
+                       [--seed 0] [--db-uri postgres:///avuewarehouse_scale]
+
+Replaces everything in the users, locations, models, stock, items,
+items_archive and alert_outbox tables with seeded random data shaped
+like a real warehouse:
+
+  * a few models account for most of the traffic (Zipf popularity), and
+    popular models also sell through faster;
+  * ship-in dates follow a yearly season that peaks before the holidays;
+  * a minority of customers place most of the orders;
+  * the first warehouse handles the most items, later ones fewer.
+
+Items are streamed into the database in chunks, using COPY on Postgres,
+so memory use stays flat however many are generated. Every synthetic
+user has the password given by --user-password.
+
+It writes to the avuewarehouse_scale database unless --db-uri says
+otherwise, never to the live one by default.
+"""
+
+import argparse
+import datetime
+import random
+import time
+from bisect import bisect
+from cStringIO import StringIO
+
+import bcrypt
+
+from model import Alert, ArchivedItem, Item, Location, Model, Stock, \
+    User, connect_to_db, db
+
+PRODUCTS = ["Camera", "Lens", "Tripod", "Monitor", "Recorder", "Battery",
+            "Charger", "Microphone", "Light", "Cable", "Mount", "Case"]
+
+MANUFACTURERS = ["Avue", "Canon", "Sony", "Panasonic", "Blackmagic",
+                 "Atomos", "Rode", "Manfrotto", "Aputure", "SmallRig"]
+
+# Relative ship-in volume by month, January first.
+SEASON = [0.7, 0.7, 0.8, 0.9, 0.9, 0.9, 0.8, 0.9, 1.1, 1.3, 1.5, 1.2]
+
+CHUNK = 50000
+
+
+class WeightedChoice(object):
+    """Pick from `values` in proportion to `weights`, in O(log n)."""
+
+    def __init__(self, values, weights):
+        self.values = values
+        self.totals = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+
+    def __call__(self, rng):
+        return self.values[bisect(self.totals, rng.random() * self.totals[-1])]
+
+
+def zipf_weights(count, exponent=1.1):
+    return [1.0 / (rank ** exponent) for rank in xrange(1, count + 1)]
+
+
+def load_users(count, password):
+    """Load `count` users who all share one password."""
+
+    print "Users"
+
+    User.query.delete()
+
+    # bcrypt is deliberately slow, so hash once and share it.
+    password_hashed = bcrypt.hashpw(password, bcrypt.gensalt())
+    db.session.execute(User.__table__.insert(),
+                       [{"user_name": "user%d" % i, "password": password_hashed}
+                        for i in xrange(1, count + 1)])
+    db.session.commit()
+
+
+def load_locations(count):
+    """Load `count` warehouses; return their ids, busiest first."""
+
+    print "Locations"
+
+    Location.query.delete()
+
+    db.session.execute(Location.__table__.insert(),
+                       [{"name": "Warehouse %d" % i}
+                        for i in xrange(1, count + 1)])
+    db.session.commit()
+
+    return [location_id for (location_id,) in db.session.query(
+        Location.location_id).order_by(Location.location_id)]
+
+
+def load_models(count, rng):
+    """Load `count` models; return their codes, most popular first."""
+
+    print "Models"
+
+    Model.query.delete()
+
+    model_codes = ["AV-%05d" % i for i in xrange(1, count + 1)]
+    db.session.execute(Model.__table__.insert(),
+                       [{"model_code": model_code,
+                         "description": "%s %s" % (rng.choice(PRODUCTS),
+                                                   model_code)}
+                        for model_code in model_codes])
+    db.session.commit()
+
+    return model_codes
+
+
+def generate_items(count, model_codes, location_ids, customers, years, rng):
+    """Yield `count` item rows, one dict per item."""
+
+    today = datetime.date.today()
+    first_day = today - datetime.timedelta(days=int(365 * years))
+    days = [first_day + datetime.timedelta(days=offset)
+            for offset in xrange((today - first_day).days + 1)]
+
+    pick_day = WeightedChoice(days, [SEASON[day.month - 1] for day in days])
+    pick_model = WeightedChoice(range(len(model_codes)),
+                                zipf_weights(len(model_codes)))
+    pick_customer = WeightedChoice(
+        ["Customer %05d" % i for i in xrange(1, customers + 1)],
+        zipf_weights(customers, 0.8))
+    pick_location = WeightedChoice(location_ids,
+                                   zipf_weights(len(location_ids), 0.7))
+
+    # The best sellers sit on the shelf for days, the long tail for months.
+    manufacturers = [rng.choice(MANUFACTURERS) for _ in model_codes]
+    mean_dwell = [7 + 173 * rank / float(len(model_codes))
+                  for rank in xrange(len(model_codes))]
+
+    for serial_number in xrange(1, count + 1):
+        rank = pick_model(rng)
+        shipped_in = pick_day(rng)
+        shipped_out = shipped_in + datetime.timedelta(
+            days=int(rng.expovariate(1.0 / mean_dwell[rank])))
+
+        row = {"model_code": model_codes[rank],
+               "shipped_in": shipped_in,
+               "shipped_out": None,
+               "serial_number": serial_number,
+               "description": model_codes[rank],
+               "manufacturer": manufacturers[rank],
+               "customer": None,
+               "location_id": pick_location(rng)}
+
+        if shipped_out <= today:
+            row["shipped_out"] = shipped_out
+            row["customer"] = pick_customer(rng)
+
+        yield row
+
+
+def copy_items(rows):
+    """Stream rows into items with Postgres COPY."""
+
+    columns = ("model_code", "shipped_in", "shipped_out", "serial_number",
+               "description", "manufacturer", "customer", "location_id")
+
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(
+            "\\N" if row[column] is None else str(row[column])
+            for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_from(buffer, Item.__tablename__, columns=columns)
+
+
+def load_items(count, model_codes, location_ids, customers, years, rng,
+               chunk=CHUNK):
+    """Stream `count` generated items into the database, a chunk at a time."""
+
+    print "Items"
+
+    Item.query.delete()
+    db.session.commit()
+
+    use_copy = db.engine.dialect.name == "postgresql"
+    started = time.time()
+    rows = []
+
+    for row in generate_items(count, model_codes, location_ids, customers,
+                              years, rng):
+        rows.append(row)
+        if len(rows) == chunk:
+            _insert_items(rows, use_copy)
+            rows = []
+            print "  %d items, %.0f/s" % (
+                row["serial_number"],
+                row["serial_number"] / (time.time() - started))
+
+    if rows:
+        _insert_items(rows, use_copy)
+
+
+def _insert_items(rows, use_copy):
+    if use_copy:
+        copy_items(rows)
+    else:
+        db.session.execute(Item.__table__.insert(), rows)
+    db.session.commit()
+
+
+def count_stock():
+    """Fill in stock from the items still on hand, per model and location."""
+
+    print "Stock"
+
+    Stock.query.delete()
+
+    on_hand = (db.select([Item.model_code, Item.location_id,
+                          db.func.count(Item.item_id)])
+               .where(Item.shipped_out == None)
+               .group_by(Item.model_code, Item.location_id))
+    db.session.execute(Stock.__table__.insert().from_select(
+        ["model_code", "location_id", "quantity"], on_hand))
+    db.session.commit()
+
+
+def generate(items, models=None, users=10, customers=None, locations=3,
+             years=3, seed=0, user_password="warehouse"):
+    """Replace the database's contents with a generated dataset.
+
+    Returns the model codes and location ids it created.
+    """
+
+    rng = random.Random(seed)
+    models = models or max(items // 2000, 5)
+    customers = customers or max(items // 500, 10)
+
+    Item.query.delete()
+    ArchivedItem.query.delete()
+    Alert.query.delete()
+    Stock.query.delete()
+    db.session.commit()
+
+    load_users(users, user_password)
+    location_ids = load_locations(locations)
+    model_codes = load_models(models, rng)
+    load_items(items, model_codes, location_ids, customers, years, rng)
+    count_stock()
+
+    return model_codes, location_ids
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--items", type=int, required=True)
+    parser.add_argument("--models", type=int)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--customers", type=int)
+    parser.add_argument("--locations", type=int, default=3)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--user-password", default="warehouse")
+    parser.add_argument("--db-uri", default="postgres:///avuewarehouse_scale")
+    args = parser.parse_args()
+
+    connect_to_db(app, db_uri=args.db_uri)
+    app.config['SQLALCHEMY_ECHO'] = False
+    db.create_all()
+
+    generate(args.items, args.models, args.users, args.customers,
+             args.locations, args.years, args.seed, args.user_password)
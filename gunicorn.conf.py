@@ -0,0 +1,51 @@
+"""gunicorn settings for the warehouse app; see wsgi.py.
+
+Every setting can be overridden from the environment for a box that
+needs something different, e.g. GUNICORN_WORKERS=3.
+"""
+
+import multiprocessing
+import os
+
+# Only nginx talks to us; see nginx.location.conf.
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5001")
+backlog = 2048
+
+# Requests spend most of their time waiting on Postgres, so each worker
+# runs a few threads and there are more workers than cores. wsgi.py sizes
+# each worker's connection pool from GUNICORN_THREADS, plus one for the
+# scan queue thread and one per image thread; the metrics thread doesn't
+# use the database.
+workers = int(os.environ.get("GUNICORN_WORKERS",
+                             multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Import the app and compile templates once, then fork.
+preload_app = True
+
+# Hold nginx's upstream connections open longer than nginx does (60s),
+# so nginx is always the side that closes an idle one.
+keepalive = 75
+
+timeout = 30
+graceful_timeout = 30
+
+# Recycle workers now and then, staggered so they don't all restart at
+# once.
+max_requests = 5000
+max_requests_jitter = 500
+
+pidfile = os.environ.get("GUNICORN_PIDFILE", "/tmp/avue-gunicorn.pid")
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    from wsgi import start_worker
+    start_worker()
+
+
+def worker_exit(server, worker):
+    from wsgi import stop_worker
+    stop_worker()
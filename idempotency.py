@@ -0,0 +1,182 @@
+"""Idempotency keys for scan submissions.
+
+Scanners on flaky Wi-Fi resend the same POST. When a request carries an
+Idempotency-Key header, the first response for that key is kept and any
+repeat gets the same response back without touching the inventory.
+
+A view saves its response with save_response() just before it commits,
+so the key is stored in the same transaction as the inventory change:
+either both happen or neither does. Two copies of a request running at
+once both try to store the key; the second one's commit fails on it and
+rolls back its changes, and it answers with the first one's response.
+
+Repeats are answered from memory when this process has seen the key,
+and otherwise from the scan_keys table, before the view runs. Scans
+going through the local scan queue keep their keys in the queue's file
+instead, so they never wait on the database; see ScanQueue.enqueue.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+from sqlalchemy.exc import IntegrityError
+
+from model import ScanKey, db
+
+KEY_HEADER = 'Idempotency-Key'
+
+KEY_TTL = timedelta(hours=24)
+
+PURGE_INTERVAL = 60
+
+RECENT_SIZE = 10000
+
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+_last_purge = [0]
+
+
+def idempotent(queued=False):
+    """Answer repeats of a keyed request with the first one's response.
+
+    A queued view hands its key to the scan queue when that's enabled,
+    which deduplicates the scan itself.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(KEY_HEADER)
+            if not key:
+                return view(*args, **kwargs)
+
+            g.idempotency_key = key = "%s %s" % (request.path, key[:64])
+
+            scan_queue = current_app.extensions.get('scan_queue')
+            if queued and scan_queue and scan_queue.enabled:
+                return view(*args, **kwargs)
+
+            saved = _recall(key) or _load(key)
+            if saved:
+                return _replay(saved)
+
+            try:
+                response = view(*args, **kwargs)
+            except IntegrityError:
+                # Most likely another copy of this request stored the key
+                # first.
+                db.session.rollback()
+                saved = _load(key)
+                if not saved:
+                    raise
+                return _replay(saved)
+
+            saved = g.pop('idempotency_saved', None)
+            if saved:
+                _remember(key, saved, datetime.utcnow())
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def request_key():
+    """The current request's idempotency key, or None if it has none."""
+
+    return g.get('idempotency_key')
+
+
+def save_response(response):
+    """Store `response` for this request's key in the current transaction.
+
+    Call it just before committing the changes the response reports;
+    returns the response, ready to send.
+    """
+
+    response = make_response(response)
+
+    key = request_key()
+    if not key:
+        return response
+
+    saved = (response.status_code, response.mimetype,
+             response.headers.get('Location'),
+             response.get_data(as_text=True))
+
+    # Rides along with the view's commit rather than needing its own.
+    _purge()
+
+    status_code, mimetype, location, body = saved
+    db.session.add(ScanKey(key=key, created_at=datetime.utcnow(),
+                           status_code=status_code, mimetype=mimetype,
+                           location=location, body=body))
+    g.idempotency_saved = saved
+
+    return response
+
+
+def _recall(key):
+    with _recent_lock:
+        entry = _recent.get(key)
+        if entry is None:
+            return None
+
+        expires, saved = entry
+        if expires < time.time():
+            del _recent[key]
+            return None
+
+        return saved
+
+
+def _remember(key, saved, created_at):
+    age = datetime.utcnow() - created_at
+    expires = time.time() + (KEY_TTL - age).total_seconds()
+
+    with _recent_lock:
+        _recent.pop(key, None)
+        _recent[key] = (expires, saved)
+        while len(_recent) > RECENT_SIZE:
+            _recent.popitem(last=False)
+
+
+def _load(key):
+    scan_key = ScanKey.query.get(key)
+    if not scan_key:
+        return None
+
+    saved = (scan_key.status_code, scan_key.mimetype, scan_key.location,
+             scan_key.body)
+    _remember(key, saved, scan_key.created_at)
+
+    return saved
+
+
+def _replay(saved):
+    status_code, mimetype, location, body = saved
+
+    response = current_app.response_class(body, status=status_code,
+                                          mimetype=mimetype)
+    if location:
+        response.headers['Location'] = location
+
+    return response
+
+
+def _purge():
+    """Drop expired keys, at most once every PURGE_INTERVAL seconds."""
+
+    now = time.time()
+    if now - _last_purge[0] < PURGE_INTERVAL:
+        return
+    _last_purge[0] = now
+
+    ScanKey.query.filter(
+        ScanKey.created_at < datetime.utcnow() - KEY_TTL).delete(
+        synchronize_session=False)
@@ -0,0 +1,197 @@
+"""Product images for items, processed off the request thread.
+
+An upload is spooled to disk, outside the store, by the request and
+handed to a small pool of worker threads. A worker hashes it, writes a display-sized JPEG and
+a thumbnail into the store under that hash, and points the item's
+img_url at them. Files are named by their content and never change, so
+they can be cached forever.
+
+Behind nginx, requests for /images/ never reach the app: nginx serves
+the store directly; see nginx.location.conf. The app's /images/ route is
+for development, and for images that should only be served after a
+check in the app: with IMAGE_ACCEL_PREFIX set it answers with an
+X-Accel-Redirect to an internal nginx location rather than sending the
+file itself.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from flask import send_from_directory
+from PIL import Image
+
+from model import Item, db
+
+DISPLAY_SIZE = (1024, 1024)
+THUMBNAIL_SIZE = (200, 200)
+
+# Larger than any camera we use takes. The pixels are checked before
+# decoding, since a small, highly compressed file can decode to
+# gigabytes, and Pillow only warns about it.
+MAX_PIXELS = 50 * 1000 * 1000
+
+# A year, the longest lifetime caches are expected to honour.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+NAME = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{40}(_thumb)?\.jpg$")
+
+
+class ImagePipeline(object):
+    """Content-addressed image store fed by a pool of worker threads."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.store = None
+        self.spool = None
+        self.workers = 2
+        self.accel_prefix = None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Use the store at IMAGE_STORE and spool uploads in IMAGE_SPOOL,
+        both next to the app by default.
+
+        The spool is kept out of the store, which nginx serves as is.
+        """
+
+        self.app = app
+        self.store = app.config.get('IMAGE_STORE') or os.path.join(
+            app.root_path, "image_store")
+        self.spool = app.config.get('IMAGE_SPOOL') or os.path.join(
+            app.root_path, "image_spool")
+        self.workers = app.config.get('IMAGE_WORKERS', 2)
+        self.accel_prefix = app.config.get('IMAGE_ACCEL_PREFIX')
+
+        for directory in (self.store, self.spool):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def submit(self, serial_number, upload):
+        """Spool an uploaded file and queue it for processing."""
+
+        handle, path = tempfile.mkstemp(dir=self.spool)
+        with os.fdopen(handle, "wb") as spooled:
+            shutil.copyfileobj(upload.stream, spooled)
+
+        self._get_pool().apply_async(self._process, (serial_number, path))
+
+    def _get_pool(self):
+        # Threads don't survive a fork, so each worker process that gets
+        # an upload starts its own pool.
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def close(self):
+        """Finish queued images and stop the workers."""
+
+        with self._lock:
+            pool, self._pool = self._pool, None
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _process(self, serial_number, path):
+        try:
+            name = self.store_image(path)
+            with self.app.app_context():
+                Item.query.filter_by(serial_number=serial_number).update(
+                    {Item.img_url: "/images/%s.jpg" % name},
+                    synchronize_session=False)
+                db.session.commit()
+                db.session.remove()
+        except Exception:
+            self.app.logger.exception("image for item %s failed",
+                                      serial_number)
+        finally:
+            os.remove(path)
+
+    def store_image(self, path):
+        """Write the display image and thumbnail for the upload at `path`.
+
+        Returns the name they're stored under, without the extension.
+        The same upload twice is only resized once.
+        """
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as upload:
+            for block in iter(lambda: upload.read(65536), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        name = "%s/%s" % (digest[:2], digest)
+        base = os.path.join(self.store, name)
+        if os.path.exists(base + "_thumb.jpg"):
+            return name
+
+        directory = os.path.dirname(base)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        image = Image.open(path)
+        width, height = image.size
+        if width * height > MAX_PIXELS:
+            raise ValueError("image is %sx%s, over %s pixels"
+                             % (width, height, MAX_PIXELS))
+        image.load()
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # The thumbnail is written last; once it exists, both do.
+        for suffix, size in [("", DISPLAY_SIZE), ("_thumb", THUMBNAIL_SIZE)]:
+            resized = image.copy()
+            resized.thumbnail(size, Image.ANTIALIAS)
+            _save_atomically(resized, base + suffix + ".jpg")
+
+        return name
+
+    def serve(self, name):
+        """Response for /images/<name>, or None if there's no such image."""
+
+        if not NAME.match(name):
+            return None
+
+        if self.accel_prefix:
+            response = self.app.response_class(mimetype="image/jpeg")
+            response.headers["X-Accel-Redirect"] = self.accel_prefix + name
+        else:
+            if not os.path.exists(os.path.join(self.store, name)):
+                return None
+            response = send_from_directory(self.store, name)
+
+        response.headers["Cache-Control"] = CACHE_CONTROL
+        return response
+
+
+def _save_atomically(image, path):
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, "wb") as output:
+            image.save(output, "JPEG", quality=85, optimize=True)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def thumbnail_url(img_url):
+    """The thumbnail's URL for an item's img_url."""
+
+    return img_url[:-len(".jpg")] + "_thumb.jpg"
@@ -0,0 +1,154 @@
+"""Stock changes shared by the web routes and the scan queue worker.
+
+Nothing in here commits; callers decide where the transaction ends so a
+single scan and a batch of queued scans go through the same code.
+"""
+
+from sqlalchemy.dialects import postgresql
+
+from model import Item, Location, Model, Stock, db
+import alerts
+
+_location_choices = []
+
+
+class InventoryError(Exception):
+    """Raised when a scan can't be applied to the inventory."""
+
+
+def adjust_stock(model_code, location_id, change):
+    """Add `change` to a model's quantity at one location."""
+
+    # A single UPDATE keeps the counter right when several scanners at a
+    # site touch the same model at once, and other sites never wait on it.
+    stock = Stock.query.filter_by(model_code=model_code,
+                                  location_id=location_id)
+    if stock.update({Stock.quantity: Stock.quantity + change},
+                    synchronize_session=False):
+        alerts.touch(model_code, change)
+        return
+
+    if not Model.query.get(model_code):
+        raise InventoryError("no such model")
+    if not Location.query.get(location_id):
+        raise InventoryError("no such location")
+
+    # First of this model at this location: create the row at zero, or
+    # leave it be if another scan just did, then count as usual.
+    db.session.execute(insert_ignoring_conflicts(Stock.__table__).values(
+        model_code=model_code, location_id=location_id, quantity=0))
+    stock.update({Stock.quantity: Stock.quantity + change},
+                 synchronize_session=False)
+    alerts.touch(model_code, change)
+
+
+def insert_ignoring_conflicts(table):
+    """An INSERT into `table` that skips rows whose key already exists."""
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    return table.insert()
+
+
+def receive_item(serial_number, description, model_code, manufacturer,
+                 shipped_in, location_id):
+    """Add a newly received item and count it at its location."""
+
+    if location_id is None:
+        raise InventoryError("no location given")
+
+    adjust_stock(model_code, location_id, 1)
+
+    item = Item(shipped_in=shipped_in,
+                serial_number=serial_number,
+                description=description,
+                model_code=model_code,
+                manufacturer=manufacturer,
+                location_id=location_id)
+    db.session.add(item)
+
+    return item
+
+
+def ship_item(serial_number, customer, shipped_out):
+    """Mark an item as shipped to a customer and take it out of stock."""
+
+    item = Item.query.filter_by(serial_number=serial_number).first()
+    if not item:
+        raise InventoryError("no such item")
+    if item.shipped_out is not None:
+        raise InventoryError("item already shipped")
+
+    adjust_stock(item.model_code, item.location_id, -1)
+
+    item.shipped_out = shipped_out
+    item.customer = customer
+
+    return item
+
+
+def transfer_items(serial_numbers, from_location_id, to_location_id):
+    """Move in-stock items between locations; return how many moved.
+
+    Items that aren't in stock at the source location are skipped. The
+    items move in one UPDATE and each model's counters change once.
+    """
+
+    if from_location_id == to_location_id:
+        raise InventoryError("items are already there")
+    if not Location.query.get(to_location_id):
+        raise InventoryError("no such location")
+
+    in_stock_there = (Item.serial_number.in_(serial_numbers),
+                      Item.location_id == from_location_id,
+                      Item.shipped_out == None)
+
+    # Lock the items first so the counts match what the UPDATE moves.
+    counts = {}
+    for (model_code,) in (db.session.query(Item.model_code)
+                          .filter(*in_stock_there)
+                          .with_for_update()):
+        counts[model_code] = counts.get(model_code, 0) + 1
+
+    if not counts:
+        return 0
+
+    Item.query.filter(*in_stock_there).update(
+        {Item.location_id: to_location_id}, synchronize_session=False)
+
+    for model_code, count in sorted(counts.items()):
+        adjust_stock(model_code, from_location_id, -count)
+        adjust_stock(model_code, to_location_id, count)
+
+    return sum(counts.values())
+
+
+def stock_by_location(model_code):
+    """[(location name, quantity)] for a model, and the total on hand."""
+
+    rows = (db.session.query(Location.name, db.func.sum(Stock.quantity))
+            .join(Stock, Stock.location_id == Location.location_id)
+            .filter(Stock.model_code == model_code)
+            .group_by(Location.name)
+            .order_by(Location.name)
+            .all())
+
+    return rows, sum(quantity for name, quantity in rows)
+
+
+def location_choices():
+    """(location_id, name) for every location, loaded once per process.
+
+    Locations are only added when a warehouse opens, alongside a deploy.
+    """
+
+    if not _location_choices:
+        _location_choices.extend(
+            db.session.query(Location.location_id, Location.name)
+            .order_by(Location.name))
+
+    return _location_choices
@@ -0,0 +1,460 @@
+"""Request timing and SQL profiling, exported at /metrics.
+
+Every request records its latency per route, how many SQL statements it
+ran and how long they took. A statement repeated many times within one
+request is logged as a likely N+1 query. Everything is collected in
+process memory and served in the Prometheus text format.
+
+Under gunicorn each worker also copies its numbers every couple of
+seconds into a SQLite file shared by all of them (see share()), and
+/metrics serves the sum over every worker, whichever one answers the
+scrape. Workers that have exited are folded into a single row, so their
+counts stay in the totals and recycling workers never looks like a
+counter reset.
+
+Set METRICS_ENABLED to False to switch collection off.
+"""
+
+import errno
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import _request_ctx_stack, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# The same statement this many times in one request is reported as N+1.
+N_PLUS_ONE_THRESHOLD = 10
+
+
+class Histogram(object):
+    """Bucketed observations, in the shape Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.add(self.counts, self.sum)
+        return histogram
+
+    def add(self, counts, total):
+        """Add another histogram's bucket counts and sum to this one."""
+
+        self.counts = [mine + theirs for mine, theirs
+                       in zip(self.counts, counts)]
+        self.sum += total
+        self.count += sum(counts)
+
+    def samples(self, name, labels):
+        """Yield the exposition lines for this histogram."""
+
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield "%s_bucket{%s,le=\"%s\"} %d" % (name, labels, bound,
+                                                  cumulative)
+        yield "%s_bucket{%s,le=\"+Inf\"} %d" % (name, labels, self.count)
+        yield "%s_sum{%s} %f" % (name, labels, self.sum)
+        yield "%s_count{%s} %d" % (name, labels, self.count)
+
+
+# (name, type, help, histogram buckets or the counter's number format)
+FAMILIES = (
+    ("avue_request_seconds", "histogram", "Request latency.",
+     LATENCY_BUCKETS),
+    ("avue_request_sql_queries", "histogram", "SQL statements per request.",
+     QUERY_COUNT_BUCKETS),
+    ("avue_sql_seconds_total", "counter", "Time spent in SQL.", "%f"),
+    ("avue_n_plus_one_total", "counter",
+     "Statements repeated %d or more times in one request."
+     % N_PLUS_ONE_THRESHOLD, "%d"),
+)
+
+FLUSH_SECONDS = 2
+
+_lock = threading.Lock()
+_store = []
+_flusher = []
+_stopping = threading.Event()
+_latency = {}
+_queries = {}
+_sql_seconds = defaultdict(float)
+_n_plus_one = defaultdict(int)
+
+
+def init_app(app):
+    """Hook request timing into the app and SQL timing into every engine."""
+
+    app.wsgi_app = _timed(app, app.wsgi_app)
+    app.after_request(_finish_request)
+    app.teardown_request(_finish_failed_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor):
+        event.listen(Engine, "before_cursor_execute", _before_cursor)
+        event.listen(Engine, "after_cursor_execute", _after_cursor)
+
+
+class RequestStats(object):
+    """What one request has spent on SQL so far."""
+
+    __slots__ = ("sql_count", "sql_seconds", "statements")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = []
+
+
+# These hooks run on every request and every statement, and each trip
+# through a context stack costs about a microsecond. So the start time
+# goes in the WSGI environ before Flask sees the request, and the other
+# hooks go through the stack once instead of through the g, request and
+# current_app proxies. Requests that run no SQL allocate nothing.
+
+START_KEY = 'avue.metrics_start'
+
+
+def _timed(app, wsgi_app):
+    config = app.config
+
+    def timed_wsgi_app(environ, start_response):
+        if config.get('METRICS_ENABLED', True):
+            environ[START_KEY] = time.time()
+        return wsgi_app(environ, start_response)
+
+    return timed_wsgi_app
+
+
+def _current_stats():
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+
+    stats = ctx.__dict__.get("metrics")
+    if stats is None and START_KEY in ctx.request.environ:
+        stats = ctx.metrics = RequestStats()
+    return stats
+
+
+def _before_cursor(conn, cursor, statement, parameters, context,
+                   executemany):
+    if _current_stats() is not None:
+        conn.info.setdefault('metrics_query_start', []).append(time.time())
+
+
+def _after_cursor(conn, cursor, statement, parameters, context,
+                  executemany):
+    stats = _current_stats()
+    started = conn.info.get('metrics_query_start')
+    if stats is None or not started:
+        return
+
+    stats.sql_count += 1
+    stats.sql_seconds += time.time() - started.pop()
+    # Counted up only for requests that ran enough statements to hold
+    # an N+1; appending is all the rest pay.
+    stats.statements.append(statement)
+
+
+def _finish_request(response):
+    _record(_request_ctx_stack.top, response.status_code)
+    return response
+
+
+def _finish_failed_request(exc):
+    # Flask skips after_request when the view raised, and answers 500.
+    ctx = _request_ctx_stack.top
+    if START_KEY in ctx.request.environ:
+        _record(ctx, 500)
+
+
+def _record(ctx, status_code):
+    request = ctx.request
+    start = request.environ.pop(START_KEY, None)
+    if start is None:
+        return
+
+    elapsed = time.time() - start
+    stats = ctx.__dict__.pop("metrics", None)
+    sql_count = stats.sql_count if stats is not None else 0
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # The raw method; request.method goes through a property per call.
+    key = (route, request.environ["REQUEST_METHOD"], status_code)
+
+    repeated = []
+    if sql_count >= N_PLUS_ONE_THRESHOLD:
+        counts = defaultdict(int)
+        for statement in stats.statements:
+            counts[statement] += 1
+        repeated = [(count, statement)
+                    for statement, count in counts.iteritems()
+                    if count >= N_PLUS_ONE_THRESHOLD]
+    for count, statement in repeated:
+        ctx.app.logger.warning("possible N+1 on %s: %d runs of %s",
+                               route, count, statement[:200])
+
+    with _lock:
+        # Each key keeps its route's query histogram alongside its own,
+        # so a request costs one lookup.
+        histograms = _latency.get(key)
+        if histograms is None:
+            histograms = _latency[key] = (
+                Histogram(LATENCY_BUCKETS),
+                _queries.setdefault(route, Histogram(QUERY_COUNT_BUCKETS)))
+        histograms[0].observe(elapsed)
+        histograms[1].observe(sql_count)
+
+        if sql_count:
+            _sql_seconds[route] += stats.sql_seconds
+        if repeated:
+            _n_plus_one[route] += len(repeated)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def snapshot():
+    """This process's series: {family: {labels: histogram or total}}."""
+
+    families = dict((family[0], {}) for family in FAMILIES)
+
+    with _lock:
+        for (route, method, status), (histogram, _) in _latency.items():
+            labels = 'route="%s",method="%s",status="%s"' % (
+                _label(route), method, status)
+            families["avue_request_seconds"][labels] = histogram.copy()
+
+        for route, histogram in _queries.items():
+            families["avue_request_sql_queries"][
+                'route="%s"' % _label(route)] = histogram.copy()
+
+        for route, seconds in _sql_seconds.items():
+            families["avue_sql_seconds_total"][
+                'route="%s"' % _label(route)] = seconds
+
+        for route, count in _n_plus_one.items():
+            families["avue_n_plus_one_total"][
+                'route="%s"' % _label(route)] = count
+
+    return families
+
+
+def render(families=None):
+    """Metrics in the Prometheus text format; this process's by default."""
+
+    if families is None:
+        families = snapshot()
+
+    lines = []
+    for name, kind, description, detail in FAMILIES:
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in sorted(families[name].items()):
+            if kind == "histogram":
+                lines.extend(value.samples(name, labels))
+            else:
+                lines.append(("%s{%s} " + detail) % (name, labels, value))
+
+    return "\n".join(lines) + "\n"
+
+
+class SharedStore(object):
+    """Every worker's latest snapshot, in one SQLite file."""
+
+    RETIRED = "retired"
+
+    def __init__(self, path):
+        # The pid alone could come round again for a later worker.
+        self.process = "%d-%d" % (os.getpid(), int(time.time() * 1000))
+        self._lock = threading.Lock()
+
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last couple of seconds in a crash is fine here.
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("""CREATE TABLE IF NOT EXISTS series (
+                            process TEXT NOT NULL,
+                            family TEXT NOT NULL,
+                            labels TEXT NOT NULL,
+                            counts TEXT,
+                            total REAL NOT NULL,
+                            PRIMARY KEY (process, family, labels))""")
+        self._conn = conn
+
+    def _transaction(self, work):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def write(self, families):
+        """Replace this process's rows with `families`."""
+
+        rows = []
+        for family, series in families.items():
+            for labels, value in series.items():
+                if isinstance(value, Histogram):
+                    rows.append((self.process, family, labels,
+                                 json.dumps(value.counts), value.sum))
+                else:
+                    rows.append((self.process, family, labels, None, value))
+
+        self._transaction(lambda: self._conn.executemany(
+            "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)", rows))
+
+    def read(self):
+        """The sum over every process, in the same shape as snapshot()."""
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT family, labels, counts, total FROM series").fetchall()
+        return _merge(rows)
+
+    def retire_exited(self):
+        """Fold the rows of workers that have exited into one set."""
+
+        def retire():
+            exited = [process for (process,) in self._conn.execute(
+                          "SELECT DISTINCT process FROM series")
+                      if process != self.RETIRED and
+                      not _running(int(process.split("-")[0]))]
+            if not exited:
+                return
+
+            owners = [self.RETIRED] + exited
+            marks = ", ".join("?" * len(owners))
+            rows = self._conn.execute(
+                "SELECT family, labels, counts, total FROM series "
+                "WHERE process IN (%s)" % marks, owners).fetchall()
+            self._conn.execute(
+                "DELETE FROM series WHERE process IN (%s)" % marks, owners)
+
+            retired = []
+            for family, series in _merge(rows).items():
+                for labels, value in series.items():
+                    if isinstance(value, Histogram):
+                        retired.append((self.RETIRED, family, labels,
+                                        json.dumps(value.counts), value.sum))
+                    else:
+                        retired.append((self.RETIRED, family, labels, None,
+                                        value))
+            self._conn.executemany(
+                "INSERT INTO series VALUES (?, ?, ?, ?, ?)", retired)
+
+        self._transaction(retire)
+
+
+def _merge(rows):
+    buckets = dict((family[0], family[3]) for family in FAMILIES)
+    families = dict((family[0], {}) for family in FAMILIES)
+
+    for family, labels, counts, total in rows:
+        series = families[family]
+        if counts is None:
+            series[labels] = series.get(labels, 0) + total
+        else:
+            if labels not in series:
+                series[labels] = Histogram(buckets[family])
+            series[labels].add(json.loads(counts), total)
+
+    return families
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def share(app):
+    """Publish this process's metrics to METRICS_STORE_PATH.
+
+    Call it in each worker after the fork. /metrics then serves the sum
+    over all workers that share the file.
+    """
+
+    path = app.config.get('METRICS_STORE_PATH')
+    if not path:
+        return
+
+    store = SharedStore(path)
+    store.retire_exited()
+    _store[:] = [store]
+
+    def flush():
+        # Workers being replaced are often still running when the new
+        # ones start, so look for exited ones again now and then.
+        for flushes in itertools.count(1):
+            if _stopping.wait(FLUSH_SECONDS):
+                return
+            try:
+                store.write(snapshot())
+                if flushes % 30 == 0:
+                    store.retire_exited()
+            except Exception:
+                app.logger.exception("couldn't publish metrics")
+
+    thread = threading.Thread(target=flush, name="metrics")
+    thread.daemon = True
+    thread.start()
+    _flusher[:] = [thread]
+
+
+def flush():
+    """Publish this process's latest numbers now, if it shares them."""
+
+    if _store:
+        _store[0].write(snapshot())
+
+
+def stop():
+    """Stop publishing in the background, after one last flush."""
+
+    _stopping.set()
+    for thread in _flusher:
+        thread.join()
+    flush()
+
+
+def metrics_view():
+    """Serve the metrics for Prometheus to scrape."""
+
+    if _store:
+        flush()
+        body = render(_store[0].read())
+    else:
+        body = render()
+
+    return current_app.response_class(
+        body, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,124 @@
+"""Bring an existing avuewarehouse database up to date with model.py.
+
+    python migrate.py [--db-uri postgres:///avuewarehouse]
+
+db.create_all() creates tables that are missing but never changes the
+ones already there. This creates the new tables and then makes the
+changes to the old ones:
+
+  * locations is filled from seed_data/u.locations if it's empty; the
+    first of those is the main warehouse;
+  * items gets a location_id, set to the main warehouse for every item;
+  * stock is filled from models.quantity at the main warehouse, and
+    models.quantity is dropped;
+  * models gets a reorder_level, empty until purchasing sets one;
+  * the indexes on items are created.
+
+Each step checks whether it's needed first, so running it again is
+harmless. Stop the app and the scan queue workers while it runs; the
+changes to existing tables happen in one transaction.
+"""
+
+import argparse
+
+from model import Item, Location, connect_to_db, db
+
+
+def columns(connection, table):
+    return set(column["name"] for column in
+               db.inspect(connection).get_columns(table))
+
+
+def load_locations(connection):
+    """Add the seed warehouses if there are none; return the main one's id."""
+
+    if not connection.execute(db.select([db.func.count()]).select_from(
+            Location.__table__)).scalar():
+        print "Locations"
+        connection.execute(Location.__table__.insert(),
+                           [{"name": row.rstrip()}
+                            for row in open("seed_data/u.locations")
+                            if row.strip()])
+
+    return connection.execute(
+        db.select([db.func.min(Location.location_id)])).scalar()
+
+
+def add_item_locations(connection, main_location_id):
+    """Give every existing item the main warehouse as its location."""
+
+    if "location_id" in columns(connection, "items"):
+        return
+
+    print "Item locations"
+
+    connection.execute("ALTER TABLE items ADD COLUMN location_id INTEGER "
+                       "REFERENCES locations (location_id)")
+    connection.execute(db.text("UPDATE items SET location_id = :location_id"),
+                       location_id=main_location_id)
+
+    # SQLite can't add the constraint afterwards; it's only for trying
+    # the migration out there.
+    if connection.dialect.name == "postgresql":
+        connection.execute(
+            "ALTER TABLE items ALTER COLUMN location_id SET NOT NULL")
+
+
+def move_quantities_to_stock(connection, main_location_id):
+    """Count each model's old quantity at the main warehouse."""
+
+    if "quantity" not in columns(connection, "models"):
+        return
+
+    print "Stock"
+
+    connection.execute(db.text(
+        "INSERT INTO stock (model_code, location_id, quantity) "
+        "SELECT model_code, :location_id, quantity FROM models "
+        "WHERE model_code NOT IN "
+        "(SELECT model_code FROM stock WHERE location_id = :location_id)"),
+        location_id=main_location_id)
+    connection.execute("ALTER TABLE models DROP COLUMN quantity")
+
+
+def add_reorder_levels(connection):
+    if "reorder_level" in columns(connection, "models"):
+        return
+
+    print "Reorder levels"
+
+    connection.execute("ALTER TABLE models ADD COLUMN reorder_level INTEGER")
+
+
+def create_indexes(connection, table):
+    existing = set(index["name"] for index in
+                   db.inspect(connection).get_indexes(table.name))
+
+    for index in table.indexes:
+        if index.name not in existing:
+            print "Index %s" % index.name
+            index.create(connection)
+
+
+def migrate():
+    db.create_all()
+
+    with db.engine.begin() as connection:
+        main_location_id = load_locations(connection)
+        add_item_locations(connection, main_location_id)
+        move_quantities_to_stock(connection, main_location_id)
+        add_reorder_levels(connection)
+        create_indexes(connection, Item.__table__)
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description="Migrate the database.")
+    parser.add_argument("--db-uri", default="postgres:///avuewarehouse")
+    args = parser.parse_args()
+
+    connect_to_db(app, db_uri=args.db_uri)
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    migrate()
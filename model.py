@@ -54,13 +54,50 @@ class Item(db.Model):
     manufacturer = db.Column(db.String(100), nullable=False)
     customer = db.Column(db.String(100), nullable=True)
     img_url = db.Column(db.String(300), nullable=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.location_id'), nullable=False)
 
     model = db.relationship('Model', backref='items')
+    location = db.relationship('Location')
+
+    # The model report filters on a model and a date range, for both dates.
+    __table_args__ = (
+        db.Index('ix_items_model_code_shipped_in', 'model_code', 'shipped_in'),
+        db.Index('ix_items_model_code_shipped_out', 'model_code', 'shipped_out'),
+        db.Index('ix_items_serial_number', 'serial_number'),
+        db.Index('ix_items_shipped_out', 'shipped_out'),
+    )
 
     def __repr__(self):
         return "<Item item_id=%s model_code=%s serial_number=%s shipped_in=%s shipped_out=%s customer=%s>" % (self.item_id, self.model_code, self.serial_number, self.shipped_out, self.shipped_in, self.customer)
 
 
+class ArchivedItem(db.Model):
+    """Items shipped out long ago, moved out of items by archive.py."""
+
+    __tablename__ = "items_archive"
+
+    item_id = db.Column(db.Integer, primary_key=True, autoincrement=False, nullable=False)
+    model_code = db.Column(db.String(50), db.ForeignKey('models.model_code'), nullable=False)
+    shipped_in = db.Column(db.Date, nullable=False)
+    shipped_out = db.Column(db.Date, nullable=False)
+    serial_number = db.Column(db.Integer, nullable=False)
+    description = db.Column(db.String(300), nullable=False)
+    manufacturer = db.Column(db.String(100), nullable=False)
+    customer = db.Column(db.String(100), nullable=True)
+    img_url = db.Column(db.String(300), nullable=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.location_id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_items_archive_model_code_shipped_in', 'model_code', 'shipped_in'),
+        db.Index('ix_items_archive_model_code_shipped_out', 'model_code', 'shipped_out'),
+        db.Index('ix_items_archive_serial_number', 'serial_number'),
+        db.Index('ix_items_archive_shipped_out', 'shipped_out'),
+    )
+
+    def __repr__(self):
+        return "<ArchivedItem item_id=%s model_code=%s serial_number=%s shipped_in=%s shipped_out=%s customer=%s>" % (self.item_id, self.model_code, self.serial_number, self.shipped_in, self.shipped_out, self.customer)
+
+
 class Model(db.Model):
     """Model numbers for items."""
 
@@ -68,11 +105,93 @@ class Model(db.Model):
 
     model_code = db.Column(db.String(50), primary_key=True, nullable=False)
     description = db.Column(db.String(300), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    
+    # Purchasing is alerted when the total on hand drops to this level.
+    reorder_level = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return "<Model model_code=%s>" % self.model_code
+
+
+class Location(db.Model):
+    """Warehouses that items are stocked in."""
+
+    __tablename__ = "locations"
+
+    location_id = db.Column(db.Integer, primary_key=True, autoincrement=True, nullable=False)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+
+    def __repr__(self):
+        return "<Location location_id=%s name=%s>" % (self.location_id, self.name)
+
+
+class Stock(db.Model):
+    """How many of a model are on hand at one location.
+
+    Quantities are kept per location so that each warehouse's scanners
+    only ever update their own rows.
+    """
+
+    __tablename__ = "stock"
+
+    model_code = db.Column(db.String(50), db.ForeignKey('models.model_code'), primary_key=True, nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.location_id'), primary_key=True, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    location = db.relationship('Location')
+
+    def __repr__(self):
+        return "<Stock model_code=%s location_id=%s quantity=%s>" % (self.model_code, self.location_id, self.quantity)
+
+
+class ScanKey(db.Model):
+    """Idempotency keys sent with scans, and the response each one got."""
+
+    __tablename__ = "scan_keys"
+
+    key = db.Column(db.String(100), primary_key=True, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+    status_code = db.Column(db.Integer, nullable=False)
+    mimetype = db.Column(db.String(100), nullable=True)
+    location = db.Column(db.String(300), nullable=True)
+    body = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return "<ScanKey key=%s status_code=%s>" % (self.key, self.status_code)
+
+
+class AppliedScan(db.Model):
+    """Queued scans that have been applied to the inventory.
+
+    Written in the same transaction as the scan's changes, so a scan the
+    queue hands out twice is only ever applied once.
+    """
+
+    __tablename__ = "applied_scans"
+
+    queue = db.Column(db.String(300), primary_key=True, nullable=False)
+    scan_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, index=True)
+    # Why the scan couldn't be applied, if it couldn't.
+    error = db.Column(db.String(300), nullable=True)
+
+    def __repr__(self):
+        return "<AppliedScan queue=%s scan_id=%s>" % (self.queue, self.scan_id)
+
+
+class Alert(db.Model):
+    """Low-stock alerts waiting to be sent, and those already sent."""
+
+    __tablename__ = "alert_outbox"
+
+    alert_id = db.Column(db.Integer, primary_key=True, autoincrement=True, nullable=False)
+    model_code = db.Column(db.String(50), db.ForeignKey('models.model_code'), nullable=False)
+    on_hand = db.Column(db.Integer, nullable=False)
+    reorder_level = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True, index=True)
 
     def __repr__(self):
-        return "<Model model_code=%s quantity=%s>" % (self.model_code, self.quantity)
+        return "<Alert alert_id=%s model_code=%s on_hand=%s reorder_level=%s>" % (self.alert_id, self.model_code, self.on_hand, self.reorder_level)
 
 
 def init_app():
@@ -0,0 +1,343 @@
+"""Durable local queue for scanner ship-in/ship-out events.
+
+When enabled, /ship_in and /ship_out only append the scan to a SQLite
+file in WAL mode and hand back its id. A background thread drains the
+queue into the warehouse database in micro-batches, one transaction per
+batch, so a slow database never holds up a scanner.
+
+Each applied scan is also recorded in applied_scans in the same
+transaction as its changes. A scan whose lease ran out while it was
+being applied, or whose worker died before marking it done, is handed
+out again; the record makes sure it changes the inventory only once.
+
+A scan sent with an idempotency key is stored with its key in the same
+transaction, and a repeat of the key gets the first scan's id back
+instead of queueing another; keys are kept as long as finished scans.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from model import AppliedScan, db
+from inventory import InventoryError, insert_ignoring_conflicts, \
+    receive_item, ship_item
+
+PENDING = "pending"
+WORKING = "working"
+DONE = "done"
+FAILED = "failed"
+
+HANDLERS = {
+    "ship_in": receive_item,
+    "ship_out": ship_item,
+}
+
+DATE_FIELDS = ("shipped_in", "shipped_out")
+
+
+class ScanQueue(object):
+    """Append-only scan log in SQLite, drained by a worker thread."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.path = None
+        self.name = None
+        self.batch_size = 100
+        self.max_wait = 0.05
+        self.lease = 60
+        self.retention = 24 * 60 * 60
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._since_wakeup = 0
+        self._claims = 0
+        self._last_purge = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def init_app(self, app):
+        """Open the queue file named by SCAN_QUEUE_PATH, if there is one."""
+
+        self.app = app
+        self.path = app.config.get('SCAN_QUEUE_PATH')
+        self.batch_size = app.config.get('SCAN_QUEUE_BATCH_SIZE', 100)
+        self.max_wait = app.config.get('SCAN_QUEUE_MAX_WAIT_MS', 50) / 1000.0
+        self.lease = app.config.get('SCAN_QUEUE_LEASE_SECONDS', 60)
+
+        if not self.path:
+            return
+
+        # Scan ids are only unique within one queue file.
+        self.name = app.config.get('SCAN_QUEUE_NAME') or "%s:%s" % (
+            socket.gethostname(), os.path.abspath(self.path))
+
+        # Autocommit mode: each enqueue is its own durable transaction and
+        # claims open theirs explicitly.
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS scans (
+                            scan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            kind TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            error TEXT,
+                            claimed_by TEXT,
+                            claimed_at REAL,
+                            queued_at REAL NOT NULL,
+                            finished_at REAL)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS ix_scans_status
+                        ON scans (status, scan_id)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS scan_keys (
+                            key TEXT PRIMARY KEY,
+                            scan_id INTEGER NOT NULL,
+                            created_at REAL NOT NULL)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS ix_scan_keys_created_at
+                        ON scan_keys (created_at)""")
+        self._conn = conn
+
+        app.extensions['scan_queue'] = self
+
+    def enqueue(self, kind, idempotency_key=None, **fields):
+        """Store a scan and return its id, which is the scanner's receipt.
+
+        If a scan was already stored with `idempotency_key`, return its id
+        instead.
+        """
+
+        if kind not in HANDLERS:
+            raise ValueError("unknown scan kind %r" % kind)
+
+        for key, value in fields.items():
+            if isinstance(value, date):
+                fields[key] = value.isoformat()
+
+        with self._lock:
+            if idempotency_key:
+                scan_id = self._keyed_scan(idempotency_key)
+                if scan_id:
+                    return scan_id
+
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process sharing the file may have stored the key
+                # since we looked.
+                scan_id = idempotency_key and self._keyed_scan(idempotency_key)
+                if not scan_id:
+                    scan_id = self._conn.execute(
+                        "INSERT INTO scans (kind, payload, status, queued_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (kind, json.dumps(fields), PENDING, now)).lastrowid
+                    if idempotency_key:
+                        self._conn.execute(
+                            "INSERT INTO scan_keys (key, scan_id, created_at) "
+                            "VALUES (?, ?, ?)", (idempotency_key, scan_id, now))
+                    self._since_wakeup += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            if self._since_wakeup >= self.batch_size:
+                self._wakeup.set()
+
+        return scan_id
+
+    def _keyed_scan(self, idempotency_key):
+        row = self._conn.execute(
+            "SELECT scan_id FROM scan_keys WHERE key = ?",
+            (idempotency_key,)).fetchone()
+        return row and row[0]
+
+    def status(self, scan_id):
+        """Return (status, error) for a scan, or None if it isn't known."""
+
+        with self._lock:
+            return self._conn.execute(
+                "SELECT status, error FROM scans WHERE scan_id = ?",
+                (scan_id,)).fetchone()
+
+    def start(self):
+        """Start draining in a daemon thread."""
+
+        if not self.enabled or self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="scan-queue")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Ask the worker to finish its current batch and exit."""
+
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.max_wait)
+            self._wakeup.clear()
+            self._since_wakeup = 0
+
+            try:
+                while self.drain() == self.batch_size:
+                    pass
+            except Exception:
+                self.app.logger.exception("scan queue drain failed")
+
+    def drain(self):
+        """Apply one batch of pending scans and return how many it held."""
+
+        token, batch = self._claim()
+        if not batch:
+            return 0
+
+        with self.app.app_context():
+            try:
+                results = self._apply(batch)
+                db.session.commit()
+            except Exception:
+                # One bad scan shouldn't hold back the rest, so fall back to
+                # a transaction per scan and fail only the ones that break.
+                db.session.rollback()
+                self.app.logger.exception("scan batch failed, retrying singly")
+                results = {}
+                for scan in batch:
+                    try:
+                        results.update(self._apply([scan]))
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        results[scan[0]] = (FAILED, str(e))
+            finally:
+                db.session.remove()
+
+            self._purge_applied()
+
+        self._finish(token, results)
+
+        return len(batch)
+
+    def _apply(self, batch):
+        results = {}
+        now = datetime.utcnow()
+
+        for scan_id, kind, payload in batch:
+            # Waits for another worker applying the same scan to commit.
+            recorded = db.session.execute(
+                insert_ignoring_conflicts(AppliedScan.__table__).values(
+                    queue=self.name, scan_id=scan_id, applied_at=now))
+            applied = AppliedScan.query.filter_by(queue=self.name,
+                                                  scan_id=scan_id)
+            if not recorded.rowcount:
+                error = applied.with_entities(AppliedScan.error).scalar()
+                results[scan_id] = (FAILED, error) if error else (DONE, None)
+                continue
+
+            fields = json.loads(payload)
+            for key in DATE_FIELDS:
+                if key in fields:
+                    fields[key] = datetime.strptime(fields[key],
+                                                    "%Y-%m-%d").date()
+            try:
+                HANDLERS[kind](**fields)
+                results[scan_id] = (DONE, None)
+            except InventoryError as e:
+                results[scan_id] = (FAILED, str(e))
+                applied.update({AppliedScan.error: str(e)},
+                               synchronize_session=False)
+
+        return results
+
+    def _purge_applied(self):
+        # Scans are handed out again within a lease or two, so a day's
+        # worth of records is plenty. Checked at most once an hour.
+        if time.time() - self._last_purge < 3600:
+            return
+        self._last_purge = time.time()
+
+        try:
+            AppliedScan.query.filter(
+                AppliedScan.queue == self.name,
+                AppliedScan.applied_at < datetime.utcnow() - timedelta(
+                    seconds=self.retention)).delete(synchronize_session=False)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+    def _claim(self):
+        """Lease the next batch to this worker; return (token, batch).
+
+        Claims are leases so that several processes can share one queue
+        file, and scans held by a worker that died get picked up again.
+        """
+
+        now = time.time()
+
+        with self._lock:
+            self._claims += 1
+            token = "%s-%s-%s" % (id(self), threading.current_thread().ident,
+                                  self._claims)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE scans SET status = ?, claimed_by = ?, claimed_at = ? "
+                    "WHERE scan_id IN (SELECT scan_id FROM scans "
+                    "WHERE status = ? OR (status = ? AND claimed_at < ?) "
+                    "ORDER BY scan_id LIMIT ?)",
+                    (WORKING, token, now, PENDING, WORKING, now - self.lease,
+                     self.batch_size))
+                batch = self._conn.execute(
+                    "SELECT scan_id, kind, payload FROM scans "
+                    "WHERE status = ? AND claimed_by = ? ORDER BY scan_id",
+                    (WORKING, token)).fetchall()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return token, batch
+
+    def _finish(self, token, results):
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Scans whose lease ran out now belong to another worker,
+                # which will report on them itself.
+                self._conn.executemany(
+                    "UPDATE scans SET status = ?, error = ?, finished_at = ? "
+                    "WHERE scan_id = ? AND claimed_by = ?",
+                    [(status, error, now, scan_id, token)
+                     for scan_id, (status, error) in results.items()])
+                self._conn.execute(
+                    "DELETE FROM scans WHERE status = ? AND finished_at < ?",
+                    (DONE, now - self.retention))
+                self._conn.execute(
+                    "DELETE FROM scan_keys WHERE created_at < ?",
+                    (now - self.retention,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
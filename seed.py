@@ -1,6 +1,7 @@
 """Utility file to seed avuewarehouse database"""
 
-from model import User, Item, Model, Role, UserRoles, connect_to_db, db
+from model import User, Alert, ArchivedItem, Item, Location, Model, Stock, \
+    connect_to_db, db
 from server import app
 import bcrypt
 
@@ -9,25 +10,54 @@ def load_items():
 
     print "Items"
 
+    # Archived items refer to models and locations too.
     Item.query.delete()
+    ArchivedItem.query.delete()
 
 
+def load_locations():
+    """Load warehouse locations into database."""
+
+    print "Locations"
+
+    Stock.query.delete()
+    Location.query.delete()
+
+    for row in open("seed_data/u.locations"):
+
+        name = row.rstrip()
+
+        location = Location(name=name)
+
+        db.session.add(location)
+
+        db.session.commit()
+
 def load_models():
-    """Load models into database."""
+    """Load models into database, with their stock at the main warehouse."""
 
     print "Models"
 
+    Alert.query.delete()
+    Stock.query.delete()
     Model.query.delete()
 
+    main_warehouse = Location.query.order_by(Location.location_id).first()
+
     for row in open("seed_data/u.model3"):
 
         row = row.rstrip()
 
         model_code, description, quantity  = row.split("|")
 
-        model = Model(model_code=model_code, description=description, quantity=quantity)
+        model = Model(model_code=model_code, description=description)
+
+        stock = Stock(model_code=model_code,
+                      location_id=main_warehouse.location_id,
+                      quantity=quantity)
 
         db.session.add(model)
+        db.session.add(stock)
 
         db.session.commit()
 
@@ -76,6 +106,7 @@ if __name__ == "__main__":
     connect_to_db(app)
 
     load_items()
+    load_locations()
     load_models()
     load_users()
     # load_roles()
@@ -4,25 +4,89 @@ from flask_debugtoolbar import DebugToolbarExtension
 from flask_security import current_user, login_required, RoleMixin, Security, \
     SQLAlchemyUserDatastore, UserMixin, utils, roles_required
 from jinja2 import StrictUndefined
+from collections import OrderedDict
 from datetime import date, datetime
+import os
 import pytz
 import bcrypt
 
 from model import User, Item, Model, connect_to_db, db
+from archive import find_item, items_between
+from idempotency import idempotent, request_key, save_response
+from images import ImagePipeline, thumbnail_url
+from inventory import InventoryError, location_choices, receive_item, \
+    ship_item, stock_by_location, transfer_items
+from scan_queue import ScanQueue
+import alerts
+import metrics
+import templating
 
 app = Flask(__name__)
 app.jinja_env.undefined = StrictUndefined
-app.jinja_env.auto_reload = True
+app.jinja_env.globals["nav_fragment"] = templating.nav_fragment
+app.jinja_env.globals["location_choices"] = location_choices
+app.jinja_env.filters["thumbnail"] = thumbnail_url
 
 app.secret_key = "ABC"
 
+# Big enough for a product photo straight off a phone.
+app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024
+
+metrics.init_app(app)
+alerts.init_app(app)
+
+scan_queue = ScanQueue()
+image_pipeline = ImagePipeline()
+
+# Looking the zone up is not free, so do it once rather than per scan.
+PACIFIC = pytz.timezone('US/Pacific')
+
+
+def today_pacific():
+    """Today's date in the warehouse's timezone."""
+
+    return datetime.now(tz=PACIFIC).date()
+
+
+def parse_date(value):
+    """Turn a YYYY-MM-DD form value into a date, or None if it isn't one."""
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def default_location_id():
+    """Where scans that don't name a location are received.
+
+    DEFAULT_LOCATION_ID if it's set, otherwise the first warehouse,
+    which is where every scanner received before there were locations.
+    """
+
+    if app.config.get('DEFAULT_LOCATION_ID'):
+        return app.config['DEFAULT_LOCATION_ID']
+
+    location_ids = [location_id for location_id, name in location_choices()]
+    return min(location_ids) if location_ids else None
+
+
+def scan_accepted(scan_id):
+    """Acknowledge a queued scan: JSON for scanners, a flash for browsers."""
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(scan_id=scan_id, status="pending"), 202
+
+    flash("Scan %s queued." % scan_id)
+    return redirect("/")
+
 
 @app.route('/')
 def go_home():
     """Goes to the homepage.  Homepage has login box.  If the user is logged in,
      it shows nothing"""
 
-    return render_template("index.html")
+    return templating.render_static("index.html")
 
 @app.route('/register', methods=['POST'])
 def register_process():
@@ -63,16 +127,17 @@ def login():
      # Get form variables
     user_name = request.form["user_name"]
     password = request.form["password"]
-    password_hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
     user = User.query.filter_by(user_name=user_name).first()
-    password_to_check = user.password
 
     if not user:
         flash("No such user")
         return redirect("/")
 
-    if (bcrypt.checkpw(password_to_check, password_hashed)) == False:
+    # checkpw hashes the attempt with the stored hash's own salt; hashing
+    # it separately with a fresh salt could never match.
+    if not bcrypt.checkpw(password.encode('utf-8'),
+                          user.password.encode('utf-8')):
         flash("Incorrect password")
         return redirect("/")
 
@@ -93,7 +158,7 @@ def logout():
 def go_to_buttons():
     """Gives choices for exploring inventory."""
 
-    return render_template("buttons.html")
+    return templating.render_static("buttons.html")
 
 @app.route('/ship_in_form')
 # @roles_required('Admin')
@@ -101,10 +166,11 @@ def go_shipped_in_form():
 
     """Gives form to fill out upon shipping in item(s)."""
 
-    return render_template("ship_in.html")
+    return templating.render_static("ship_in.html")
 
 @app.route('/ship_in', methods=["POST"])
 # @roles_required('Admin')
+@idempotent(queued=True)
 def shipped_in():
     """Receiving item and inputting information associated with item."""
 
@@ -112,83 +178,125 @@ def shipped_in():
     description = request.form.get("description")
     model_code = request.form.get("model_code")
     manufacturer = request.form.get("manufacturer")
+    location_id = request.form.get("location_id", type=int) or \
+        default_location_id()
+
+    if scan_queue.enabled:
+        scan_id = scan_queue.enqueue("ship_in",
+                                     idempotency_key=request_key(),
+                                     serial_number=serial_number,
+                                     description=description,
+                                     model_code=model_code,
+                                     manufacturer=manufacturer,
+                                     shipped_in=today_pacific(),
+                                     location_id=location_id)
+        return scan_accepted(scan_id)
+
+    try:
+        receive_item(serial_number=serial_number,
+                     description=description,
+                     model_code=model_code,
+                     manufacturer=manufacturer,
+                     shipped_in=today_pacific(),
+                     location_id=location_id)
+    except InventoryError as e:
+        flash(str(e))
+        return redirect("/ship_in_form")
+
+    response = save_response(redirect("/"))
+    db.session.commit()
 
-    pacific = pytz.timezone('US/Pacific')
-    time = datetime.now(tz=pacific)
-    shipped_in = "%s/%s/%s" % (time.month, time.day, time.year)
-
-    item = Item(shipped_in=shipped_in,
-                serial_number=serial_number,
-                description=description,
-                model_code=model_code,
-                manufacturer=manufacturer)  
-    
-    model = Model.query.filter_by(model_code=model_code).first()
-    if not model:
-        flash("no such model")
-        return redirect ("/ship_in")
-        
-    if model:
-        model.quantity += 1
-    else:
-        model = Model(model_code=model_code,
-                quantity=1)
-        db.session.add(model)
-        db.session.commit()
-
-    db.session.add(item)
-    db.session.commit() 
-
-    return redirect("/")
+    return response
 
 @app.route('/ship_out_form')
 # @roles_required('Admin,)
 def go_shipped_out_form():
     """Gives form to fill out upon shipping out item(s)."""
 
-    return render_template("ship_out.html")
+    return templating.render_static("ship_out.html")
 
 @app.route('/ship_out', methods=["POST"])
 # @roles_required('Admin')
+@idempotent(queued=True)
 def shipped_out():
     """Shipping out an item and inputting information about customer."""
 
     serial_number = request.form.get("serial_number")
     customer = request.form.get("customer")
 
-    item = Item.query.filter_by(serial_number=serial_number).first()
-    if not item:
-        flash("no such item")
-        return redirect("/ship_out")
+    if scan_queue.enabled:
+        scan_id = scan_queue.enqueue("ship_out",
+                                     idempotency_key=request_key(),
+                                     serial_number=serial_number,
+                                     customer=customer,
+                                     shipped_out=today_pacific())
+        return scan_accepted(scan_id)
+
+    try:
+        ship_item(serial_number=serial_number,
+                  customer=customer,
+                  shipped_out=today_pacific())
+    except InventoryError as e:
+        flash(str(e))
+        return redirect("/ship_out_form")
+
+    response = save_response(redirect('/'))
+    db.session.commit()
 
-    pacific = pytz.timezone('US/Pacific')
-    time = datetime.now(tz=pacific)
-    shipped_out = "%s/%s/%s" % (time.month, time.day, time.year)
+    return response
 
-    item.shipped_out = shipped_out
-    item.customer = customer
-    db.session.commit()
+@app.route('/transfer_form')
+# @roles_required('Admin')
+def go_transfer_form():
+    """Gives form for moving items between warehouses."""
 
-    model_code = item.model_code
-    print model_code
-    model = Model.query.filter_by(model_code=model_code).first()
-    
-    if not model:
-        flash("no model for item")
-        return redirect("/shipt_out")
-    
-    print model
-    model.quantity -= 1
+    return templating.render_static("transfer.html")
+
+@app.route('/transfer', methods=["POST"])
+# @roles_required('Admin')
+@idempotent()
+def transfer():
+    """Move a batch of in-stock items from one warehouse to another."""
+
+    entered = request.form.get("serial_numbers", "").replace(",", " ")
+    serial_numbers = [int(serial_number) for serial_number in entered.split()
+                      if serial_number.isdigit()]
+    from_location_id = request.form.get("from_location_id", type=int)
+    to_location_id = request.form.get("to_location_id", type=int)
+
+    if not serial_numbers:
+        flash("no serial numbers given")
+        return redirect("/transfer_form")
+
+    try:
+        moved = transfer_items(serial_numbers, from_location_id, to_location_id)
+    except InventoryError as e:
+        flash(str(e))
+        return redirect("/transfer_form")
+
+    flash("Moved %s of %s items." % (moved, len(serial_numbers)))
+    response = save_response(redirect("/transfer_form"))
     db.session.commit()
 
-    return redirect('/')
+    return response
+
+@app.route('/scans/<int:scan_id>')
+def get_scan_status(scan_id):
+    """Let a scanner check what became of a queued scan."""
+
+    scan = scan_queue.status(scan_id) if scan_queue.enabled else None
+    if not scan:
+        return jsonify(error="no such scan"), 404
+
+    status, error = scan
+    return jsonify(scan_id=scan_id, status=status, error=error)
 
 @app.route('/form_for_model_number')
 # @roles_required('Admin')
 def see_model_number():
     """Get model number in order to give information."""
 
-    return render_template("form_for_model_number.html")
+    return templating.render_static("form_for_model_number.html")
 
 @app.route('/info_for_model_number', methods=["POST"])
 # @roles_required('Admin')
@@ -196,90 +304,96 @@ def get_info_by_model_number():
     """Get information by model number for given timeframe."""
 
     model_code = request.form.get("model_code")
-    starting_date = request.form.get("start_date")
-    ending_date = request.form.get("end_date")
+    starting_date = parse_date(request.form.get("start_date"))
+    ending_date = parse_date(request.form.get("end_date"))
 
-    # starting_date = datetime.strptime(starting_date, "%Y-%m-%d")
-    # ending_date = datetime.strptime(ending_date, "%Y-%m-%d")
+    if not starting_date or not ending_date:
+        flash("dates must be given as YYYY-MM-DD")
+        return redirect("/form_for_model_number")
+
+    if starting_date > ending_date:
+        flash("starting date is after ending date")
+        return redirect("/form_for_model_number")
 
     model = Model.query.filter_by(model_code=model_code).first()
     if not model:
             flash("no such model")
-            return redirect("/info_for_model_number")
+            return redirect("/form_for_model_number")
+
+    # Both lookups are range scans on (model_code, date) and come back
+    # already ordered by date, so grouping below keeps that order.
+    items_received = items_between(model_code, "shipped_in",
+                                   starting_date, ending_date)
 
-    items_received = db.session.query(Item).filter(Item.model_code==model_code).filter(Item.shipped_in.between(starting_date, ending_date)).all()
-    
     count_items_received = len(items_received)
 
-    dates_shipped_in = {}
+    dates_shipped_in = OrderedDict()
 
     for item in items_received:
-        if item.shipped_in in dates_shipped_in:
-            dates_shipped_in[item.shipped_in][0] += 1
-            dates_shipped_in[item.shipped_in].append([item.manufacturer, "none", item.serial_number])
-        else:
-            dates_shipped_in[item.shipped_in] = [1]
-            dates_shipped_in[item.shipped_in].append([item.manufacturer, "none", item.serial_number])
-    print dates_shipped_in
+        day = dates_shipped_in.setdefault(item.shipped_in, [0])
+        day[0] += 1
+        day.append([item.manufacturer, "none", item.serial_number])
 
-    items_shipped = db.session.query(Item).filter(Item.model_code==model_code).filter(Item.shipped_out.between(starting_date, ending_date)).all()
+    items_shipped = items_between(model_code, "shipped_out",
+                                  starting_date, ending_date)
 
     count_items_shipped = len(items_shipped)
 
-    dates_shipped_out = {}
+    dates_shipped_out = OrderedDict()
 
     for item in items_shipped:
-        if item.shipped_out in dates_shipped_out:
-            dates_shipped_out[item.shipped_out][0] += 1
-            dates_shipped_out[item.shipped_out].append(["none", item.customer, item.serial_number])
-        else:
-            dates_shipped_out[item.shipped_out] = [1]
-            dates_shipped_out[item.shipped_out].append(["none", item.customer, item.serial_number])
-    print dates_shipped_out
-
-    dates = []
-
-    for date in dates_shipped_in:
-        dates.append(date)
-    for date in dates_shipped_out:
-        dates.append(date)
-
-    dates = set(dates)
-    dates = list(dates)
-    dates = sorted(dates)
-    print dates
-
-    dates_info = {}
-
-    for date in dates:
-        if date in dates_shipped_in and date not in dates_shipped_out:
-            dates_info[date] = [dates_shipped_in[date][0]]
-            dates_info[date].append(0)
-        if date in dates_shipped_in and date in dates_shipped_out:
-            dates_info[date] = [dates_shipped_in[date][0]]
-            dates_info[date].append(dates_shipped_out[date][0])
-        if date in dates_shipped_out and date not in dates_shipped_in:
-            dates_info[date] = [0]
-            dates_info[date].append(dates_shipped_in[date][0])
-        if date in dates_shipped_in:
-            dates_info[date].extend(dates_shipped_in[date][1:])
-        if date in dates_shipped_out:
-            dates_info[date].extend(dates_shipped_out[date][1:])
-    print dates_info
+        day = dates_shipped_out.setdefault(item.shipped_out, [0])
+        day[0] += 1
+        day.append(["none", item.customer, item.serial_number])
+
+    # Keys are real dates, so the merged report sorts chronologically
+    # rather than as month/day/year strings.
+    dates_info = OrderedDict()
+
+    for day in sorted(set(dates_shipped_in) | set(dates_shipped_out)):
+        received = dates_shipped_in.get(day, [0])
+        shipped = dates_shipped_out.get(day, [0])
+        dates_info[day] = [received[0], shipped[0]] + received[1:] + shipped[1:]
+
+    stock, total_on_hand = stock_by_location(model_code)
 
     return render_template("info_for_model_number.html", model=model,  
         model_code=model_code, dates_info=dates_info,
+        stock=stock, total_on_hand=total_on_hand,
         count_items_received=count_items_received, 
         items_received=items_received, dates_shipped_in=dates_shipped_in, 
         count_items_shipped=count_items_shipped, 
         items_shipped=items_shipped, dates_shipped_out=dates_shipped_out)
 
+@app.route('/reorder_level', methods=["POST"])
+# @roles_required('Admin')
+def set_reorder_level():
+    """Set the on-hand level at which purchasing is alerted for a model."""
+
+    model_code = request.form.get("model_code")
+    reorder_level = request.form.get("reorder_level", type=int)
+
+    model = Model.query.get(model_code)
+    if not model:
+        flash("no such model")
+        return redirect("/form_for_model_number")
+
+    alerts.level_changed(model_code, model.reorder_level)
+    model.reorder_level = reorder_level
+    db.session.commit()
+
+    if reorder_level is None:
+        flash("No reorder level for %s." % model_code)
+    else:
+        flash("Reorder %s at %s." % (model_code, reorder_level))
+    return redirect("/form_for_model_number")
+
 @app.route('/form_for_serial_number')
 # @roles_required('Admin')
 def see_serial_number():
     """Get serial number in order to give information."""
 
-    return render_template("form_for_serial_number.html")
+    return templating.render_static("form_for_serial_number.html")
 
 @app.route('/info_for_serial_number', methods=["POST"])
 # @roles_required('Admin')
@@ -288,18 +402,62 @@ def get_info_by_serial_number():
 
     serial_number = request.form.get("serial_number")
 
-    item = Item.query.filter_by(serial_number=serial_number).first()
-    print item
-    
+    item = find_item(serial_number)
+
     if not item:
         flash("no such item")
         return redirect("/form_for_serial_number")
 
     return render_template("info_for_serial_number.html", item=item)
 
+@app.route('/upload_image', methods=["POST"])
+def upload_image():
+    """Take a product image for an item; it's resized in the background."""
+
+    serial_number = request.form.get("serial_number", type=int)
+    upload = request.files.get("image")
+
+    if not Item.query.filter_by(serial_number=serial_number).first():
+        flash("no such item")
+        return redirect("/form_for_serial_number")
+    if not upload or not upload.filename:
+        flash("Choose an image to upload.")
+        return redirect("/form_for_serial_number")
+
+    image_pipeline.submit(serial_number, upload)
+
+    flash("Image for item %s received; it will appear shortly." % serial_number)
+    return redirect("/form_for_serial_number")
+
+@app.route('/images/<path:name>')
+def image(name):
+    """Send an item image, or hand it to nginx if IMAGE_ACCEL_PREFIX is set."""
+
+    response = image_pipeline.serve(name)
+    if response is None:
+        return "No such image", 404
+    return response
+
 
 if __name__ == "__main__":    
     connect_to_db(app)
+    templating.init_app(app)
+
+    if os.environ.get('DEFAULT_LOCATION_ID'):
+        app.config['DEFAULT_LOCATION_ID'] = int(
+            os.environ['DEFAULT_LOCATION_ID'])
+
+    # Set SCAN_QUEUE_PATH to have scanners write to the local queue and
+    # let a background thread load their scans into the database.
+    app.config['SCAN_QUEUE_PATH'] = os.environ.get('SCAN_QUEUE_PATH')
+    scan_queue.init_app(app)
+    scan_queue.start()
+
+    # The app sends image files itself unless IMAGE_ACCEL_PREFIX names an
+    # internal nginx location to hand them to.
+    app.config['IMAGE_ACCEL_PREFIX'] = os.environ.get('IMAGE_ACCEL_PREFIX')
+    image_pipeline.init_app(app)
+
     # We have to set debug=True here, since it has to be True at the
     # point that we invoke the DebugToolbarExtension
     app.debug = True
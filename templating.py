@@ -0,0 +1,87 @@
+"""Template compilation and page caching.
+
+In production the templates don't change under a running server, so
+they are compiled once at startup into a bytecode cache and never
+stat'ed again. Pages that only depend on whether someone is logged in
+are rendered once per login state and reused. The navbar from base.html
+is cached the same way for every other page.
+"""
+
+import os
+import tempfile
+import threading
+
+from flask import Markup, current_app, render_template, session
+from jinja2 import FileSystemBytecodeCache
+
+_pages = {}
+_fragments = {}
+_lock = threading.Lock()
+
+
+def init_app(app, production=False):
+    """Set templates up for development (reloading) or production."""
+
+    app.config['CACHE_STATIC_PAGES'] = production
+
+    if not production:
+        app.jinja_env.auto_reload = True
+        return
+
+    app.jinja_env.auto_reload = False
+
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(
+        tempfile.gettempdir(), 'avue-templates')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    precompile(app)
+
+
+def precompile(app):
+    """Load every template so no request pays for parsing or compiling."""
+
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+def clear():
+    """Forget cached pages and fragments."""
+
+    with _lock:
+        _pages.clear()
+        _fragments.clear()
+
+
+def render_static(template_name):
+    """Render a page whose only state is the login and flashed messages."""
+
+    # Flashed messages are one-off, so those renders are never cached.
+    if not current_app.config.get('CACHE_STATIC_PAGES') or \
+            session.get('_flashes'):
+        return render_template(template_name)
+
+    key = (template_name, "user_id" in session)
+    page = _pages.get(key)
+    if page is None:
+        page = render_template(template_name)
+        with _lock:
+            _pages[key] = page
+
+    return page
+
+
+def nav_fragment():
+    """The navbar for the current login state, rendered once per state."""
+
+    logged_in = "user_id" in session
+    fragment = _fragments.get(logged_in)
+    if fragment is None:
+        template = current_app.jinja_env.get_template("_nav.html")
+        fragment = Markup(template.render(logged_in=logged_in))
+        if current_app.config.get('CACHE_STATIC_PAGES'):
+            with _lock:
+                _fragments[logged_in] = fragment
+
+    return fragment
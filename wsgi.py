@@ -0,0 +1,100 @@
+"""Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is built once in the gunicorn master, with templates compiled
+and the model layer warmed up, and the workers fork from it already
+loaded. Each worker then opens its own database connections and scan
+queue in start_worker(), and its own image pool on its first upload,
+since none of those can be shared across a fork. Workers publish their
+metrics to METRICS_STORE_PATH, so /metrics shows totals for the whole
+server whichever worker answers the scrape.
+
+Set DATABASE_URL to point at another database, and SCAN_QUEUE_PATH,
+IMAGE_ACCEL_PREFIX and DEFAULT_LOCATION_ID as for the development
+server.
+
+To deploy new code without dropping requests, start a new master next
+to the old one and then retire the old one:
+
+    kill -USR2 $(cat /tmp/avue-gunicorn.pid)
+    kill -QUIT $(cat /tmp/avue-gunicorn.pid.oldbin)
+
+A HUP only restarts the workers, which fork from the master's copy of
+the code; that's enough for config changes, not for a deploy.
+"""
+
+import os
+import tempfile
+
+from sqlalchemy.orm import configure_mappers
+
+from server import app, image_pipeline, scan_queue
+from model import connect_to_db, db
+from inventory import location_choices
+import metrics
+import templating
+
+
+def create_app(db_uri=None):
+    """Configure the app for production and load what it can up front."""
+
+    connect_to_db(app, db_uri or os.environ.get('DATABASE_URL',
+                                                'postgres:///avuewarehouse'))
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['SCAN_QUEUE_PATH'] = os.environ.get('SCAN_QUEUE_PATH')
+    app.config['IMAGE_ACCEL_PREFIX'] = os.environ.get('IMAGE_ACCEL_PREFIX')
+    if os.environ.get('DEFAULT_LOCATION_ID'):
+        app.config['DEFAULT_LOCATION_ID'] = int(
+            os.environ['DEFAULT_LOCATION_ID'])
+    app.config['METRICS_STORE_PATH'] = os.environ.get(
+        'METRICS_STORE_PATH',
+        os.path.join(tempfile.gettempdir(), 'avue-metrics.db'))
+
+    templating.init_app(app, production=True)
+    image_pipeline.init_app(app)
+
+    # Keep a connection for every thread in a worker that uses the
+    # database: gunicorn's request threads, the scan queue's and the image
+    # pool's. Connections past the pool size are closed again after each
+    # use rather than kept. (A SQLite file has no pool to size.)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config['SQLALCHEMY_POOL_SIZE'] = (
+            int(os.environ.get('GUNICORN_THREADS', 4)) + 1 +
+            image_pipeline.workers)
+
+    # Build the mappers and the location list now rather than on some
+    # worker's first request; threads in a worker would otherwise race
+    # to fill the location cache.
+    configure_mappers()
+    with app.app_context():
+        location_choices()
+        db.session.remove()
+
+        # The warm-up's connection must not be inherited by every worker.
+        db.engine.dispose()
+
+    return app
+
+
+def start_worker():
+    """Set up what each worker process needs for itself after the fork."""
+
+    with app.app_context():
+        db.engine.dispose()
+
+    scan_queue.init_app(app)
+    scan_queue.start()
+
+    metrics.share(app)
+
+
+def stop_worker():
+    """Let queued scans and images finish before the worker exits."""
+
+    scan_queue.stop()
+    image_pipeline.close()
+    metrics.stop()
+
+
+app = create_app()